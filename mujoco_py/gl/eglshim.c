@@ -211,7 +211,8 @@ void readPBO(unsigned char *buffer_rgb, unsigned short *buffer_depth,
         glBindBuffer(GL_PIXEL_PACK_BUFFER_ARB, pbo_rgb);
 
         GLubyte* src_rgb = (GLubyte*) glMapBufferARB(GL_PIXEL_PACK_BUFFER_ARB, GL_READ_ONLY_ARB);
-        memcpy(buffer_rgb, src_rgb, batchSize * width * height * 3);
+        if (src_rgb)
+            memcpy(buffer_rgb, src_rgb, batchSize * width * height * 3);
 
         glUnmapBuffer(GL_PIXEL_PACK_BUFFER_ARB);
     }
@@ -219,7 +220,8 @@ void readPBO(unsigned char *buffer_rgb, unsigned short *buffer_depth,
         glBindBuffer(GL_PIXEL_PACK_BUFFER_ARB, pbo_depth);
 
         GLushort* src_depth = (GLushort*) glMapBufferARB(GL_PIXEL_PACK_BUFFER_ARB, GL_READ_ONLY_ARB);
-        memcpy(buffer_depth, src_depth, batchSize * width * height * sizeof(GLushort));
+        if (src_depth)
+            memcpy(buffer_depth, src_depth, batchSize * width * height * sizeof(GLushort));
 
         glUnmapBuffer(GL_PIXEL_PACK_BUFFER_ARB);
     }
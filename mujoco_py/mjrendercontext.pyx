@@ -1,4 +1,3 @@
-from threading import Lock
 from mujoco_py.generated import const
 import numpy as np
 cimport numpy as np
@@ -167,6 +166,8 @@ cdef class MjRenderContext(object):
         
         mjr_render(rect, &self._scn, &self._con)
         for gridpos, (text1, text2) in self._overlay.items():
+            if not (text1 or text2):
+                continue  # emptied by _overlay_reset
             mjr_overlay(const.FONTSCALE_150, gridpos, rect, text1.encode(), text2.encode(), &self._con)
 
         if segmentation:
@@ -220,6 +221,47 @@ cdef class MjRenderContext(object):
             cdef float[::view.contiguous] buffer_view = buffer.ravel()
             mjr_readPixels(NULL, &buffer_view[0], rect, &self._con)
 
+    def create_pbo(self, int width, int height):
+        '''
+        Allocates a pixel buffer object (PBO) for asynchronous RGB readback.
+        Returns 0 if PBOs are not supported by the OpenGL backend (only EGL is).
+        '''
+        self.opengl_context.make_context_current()
+        return createPBO(width, height, 1, 0)
+
+    def free_pbo(self, unsigned int pbo):
+        ''' Frees a PBO allocated with `create_pbo`. '''
+        if pbo:
+            self.opengl_context.make_context_current()
+            freePBO(pbo)
+
+    def read_pixels_to_pbo(self, int width, int height, unsigned int pbo):
+        '''
+        Starts reading the RGB pixels of the last render into `pbo`. This
+        returns without waiting for the transfer; use `read_pbo` to fetch them.
+        '''
+        cdef mjrRect rect
+        rect.left = 0
+        rect.bottom = 0
+        rect.width = width
+        rect.height = height
+        self.opengl_context.make_context_current()
+        copyFBOToPBO(&self._con, pbo, 0, rect, 0)
+
+    def read_pbo(self, int width, int height, unsigned int pbo, out=None):
+        '''
+        Maps `pbo` and copies its RGB pixels into `out`, a preallocated
+        contiguous (height, width, 3) uint8 array, or into a new array.
+        '''
+        if out is None:
+            out = np.empty((height, width, 3), dtype=np.uint8)
+        elif out.shape != (height, width, 3) or out.dtype != np.uint8:
+            raise ValueError("out must be a uint8 array of shape %s" % ((height, width, 3),))
+        cdef unsigned char[:, :, ::1] rgb_view = out
+        self.opengl_context.make_context_current()
+        readPBO(&rgb_view[0, 0, 0], NULL, pbo, 0, width, height, 1)
+        return out
+
     def upload_texture(self, int tex_id):
         """ Uploads given texture to the GPU. """
         self.opengl_context.make_context_current()
@@ -246,6 +288,12 @@ cdef class MjRenderContext(object):
         self._overlay[gridpos][0] += text1 + "\n"
         self._overlay[gridpos][1] += text2 + "\n"
 
+    def _overlay_reset(self):
+        """ Empties the overlay text, keeping the entries for reuse by add_overlay. """
+        for entry in self._overlay.values():
+            entry[0] = ""
+            entry[1] = ""
+
     def add_marker(self, **marker_params):
         self._markers.append(marker_params)
 
@@ -1,4 +1,3 @@
-import copy
 import glfw
 import imageio
 import numpy as np
@@ -7,9 +6,7 @@ import sys
 
 from mujoco_py.builder import cymj
 from mujoco_py.generated import const
-from mujoco_py.utils import rec_copy, rec_assign
-from multiprocessing import Process, Queue
-from threading import Lock
+from threading import Event, Lock, Semaphore, Thread
 
 
 class MjViewerBasic(cymj.MjRenderContextWindow):
@@ -32,11 +29,24 @@ class MjViewerBasic(cymj.MjRenderContextWindow):
         self._button_right_pressed = False
         self._last_mouse_x = 0
         self._last_mouse_y = 0
-
-        framebuffer_width, _ = glfw.get_framebuffer_size(self.window)
-        window_width, _ = glfw.get_window_size(self.window)
-        self._scale = framebuffer_width * 1.0 / window_width
-
+        # Shift keys held down, tracked in key_callback so that mouse
+        # callbacks need not query them.
+        self._shift_keys_pressed = set()
+        # Set whenever the displayed image may have changed; lets MjViewer
+        # skip re-rendering an unchanged paused scene.
+        self._dirty = True
+
+        # The framebuffer size is cached, and refreshed on resize, since the
+        # mouse callbacks need it on every event.
+        self._fb_w, self._fb_h = 0, 0
+        self._scale = 1.0
+        self._need_scale = False
+        self._inv_height = 0.0
+        self._fb_resize_callback(
+            self.window, *glfw.get_framebuffer_size(self.window))
+
+        glfw.set_framebuffer_size_callback(self.window, self._fb_resize_callback)
+        glfw.set_window_refresh_callback(self.window, self._window_refresh_callback)
         glfw.set_cursor_pos_callback(self.window, self._cursor_pos_callback)
         glfw.set_mouse_button_callback(
             self.window, self._mouse_button_callback)
@@ -61,7 +71,12 @@ class MjViewerBasic(cymj.MjRenderContextWindow):
         glfw.poll_events()
 
     def key_callback(self, window, key, scancode, action, mods):
-        if action == glfw.RELEASE and key == glfw.KEY_ESCAPE:
+        if key == glfw.KEY_LEFT_SHIFT or key == glfw.KEY_RIGHT_SHIFT:
+            if action == glfw.RELEASE:
+                self._shift_keys_pressed.discard(key)
+            else:
+                self._shift_keys_pressed.add(key)
+        elif action == glfw.RELEASE and key == glfw.KEY_ESCAPE:
             print("Pressed ESC")
             self.exit = True
 
@@ -70,9 +85,7 @@ class MjViewerBasic(cymj.MjRenderContextWindow):
             return
 
         # Determine whether to move, zoom or rotate view
-        mod_shift = (
-            glfw.get_key(window, glfw.KEY_LEFT_SHIFT) == glfw.PRESS or
-            glfw.get_key(window, glfw.KEY_RIGHT_SHIFT) == glfw.PRESS)
+        mod_shift = bool(self._shift_keys_pressed)
         if self._button_right_pressed:
             action = const.MOUSE_MOVE_H if mod_shift else const.MOUSE_MOVE_V
         elif self._button_left_pressed:
@@ -81,15 +94,19 @@ class MjViewerBasic(cymj.MjRenderContextWindow):
             action = const.MOUSE_ZOOM
 
         # Determine
-        dx = int(self._scale * xpos) - self._last_mouse_x
-        dy = int(self._scale * ypos) - self._last_mouse_y
-        width, height = glfw.get_framebuffer_size(window)
+        if self._need_scale:
+            sx, sy = int(self._scale * xpos), int(self._scale * ypos)
+        else:
+            sx, sy = int(xpos), int(ypos)
+        dx = sx - self._last_mouse_x
+        dy = sy - self._last_mouse_y
 
         with self._gui_lock:
-            self.move_camera(action, dx / height, dy / height)
+            self.move_camera(action, dx * self._inv_height, dy * self._inv_height)
+        self._dirty = True
 
-        self._last_mouse_x = int(self._scale * xpos)
-        self._last_mouse_y = int(self._scale * ypos)
+        self._last_mouse_x = sx
+        self._last_mouse_y = sy
 
     def _mouse_button_callback(self, window, button, act, mods):
         self._button_left_pressed = (
@@ -98,12 +115,57 @@ class MjViewerBasic(cymj.MjRenderContextWindow):
             glfw.get_mouse_button(window, glfw.MOUSE_BUTTON_RIGHT) == glfw.PRESS)
 
         x, y = glfw.get_cursor_pos(window)
-        self._last_mouse_x = int(self._scale * x)
-        self._last_mouse_y = int(self._scale * y)
+        self._last_mouse_x, self._last_mouse_y = self._scale_mouse_pos(x, y)
+
+    def _scale_mouse_pos(self, x, y):
+        # Converts window coordinates to framebuffer pixels.
+        if self._need_scale:
+            return int(self._scale * x), int(self._scale * y)
+        return int(x), int(y)
+
+    def _fb_resize_callback(self, window, width, height):
+        window_width, _ = glfw.get_window_size(window)
+        if width == 0 or height == 0 or window_width == 0:
+            return  # minimized
+        self._fb_w, self._fb_h = width, height
+        self._scale = width * 1.0 / window_width
+        self._need_scale = self._scale != 1.0
+        self._inv_height = 1.0 / height
+        self._dirty = True
+
+    def _window_refresh_callback(self, window):
+        # The window was exposed and its contents need to be redrawn.
+        self._dirty = True
 
     def _scroll_callback(self, window, x_offset, y_offset):
         with self._gui_lock:
             self.move_camera(const.MOUSE_ZOOM, 0, -0.05 * y_offset)
+        self._dirty = True
+
+
+# Constant (label, key) lines of the custom key bindings overlay.
+_CUSTOM_KEYS_OVERLAY = (
+    ("Toggle adaptation", "[LEFT SHIFT]"),
+    ("Move target - X", "[o]"),
+    ("Move target + X", "[p]"),
+    ("Move target - Y", "[l]"),
+    ("Move target + Y", "[;]"),
+    ("Move target - Z", "[.]"),
+    ("Move target + Z", "[/]"),
+    ("Follow target", "[a]"),
+    ("Pick up object", "[z]"),
+    ("Drop off up object", "[x]"),
+    ("Toggle path vis", "[w]"),
+    ("Increase gravity", "[g]"),
+    ("Decrease gravity", "[b]"),
+    ("Dumbbell mass +1kg", "[u]"),
+    ("Dumbbell mass -1kg", "[y]"),
+    ("Earth Gravity", "[q]"),
+    ("Moon Gravity", "[i]"),
+    ("Mars Gravity", "[k]"),
+    ("Jupiter Gravity", "[,]"),
+    ("ISS Gravity", "[qj"),
+)
 
 
 class MjViewer(MjViewerBasic):
@@ -132,6 +194,15 @@ class MjViewer(MjViewerBasic):
         The simulator to display.
     """
 
+    # z component of gravity on the planets selectable with the gravity keys.
+    _GRAVITIES = {
+        'earth': -9.81,
+        'moon': -1.62,
+        'mars': -3.71,
+        'jupiter': -24.92,
+        'ISS': 0,
+        }
+
     def __init__(self, sim, display_all_text=False):
         super().__init__(sim)
 
@@ -143,25 +214,56 @@ class MjViewer(MjViewerBasic):
 
         # Vars for recording video
         self._record_video = False
-        self._video_queue = Queue()
         self._video_idx = 0
+        # Frames are handed to the encoder thread through a bounded ring of
+        # reusable buffers: the viewer waits on _frame_free for a slot to copy
+        # into, the encoder waits on _frame_filled for a slot to encode. The
+        # encoder sets _frame_stopped before it exits.
+        self._video_ring_size = 4
+        self._frame_ring = None
+        self._frame_free = None
+        self._frame_filled = None
+        self._frame_stopped = None
+        self._frame_tail = 0
+        self._video_thread = None
         self._video_path = "/tmp/video_%07d.mp4"
 
+        # Double-buffered PBOs for reading back video frames asynchronously.
+        # Allocated lazily since the offscreen context may not exist yet.
+        self._pbo_ring = [0, 0]
+        self._pbo_idx = 0
+        self._pbo_size = None
+        self._pbo_pending = False
+        self._pbo_read_buf = None
+
         # vars for capturing screen
         self._image_idx = 0
         self._image_path = "/tmp/frame_%07d.png"
+        self._cached_capture_res = {}
+        # Screenshots are written on a worker thread so PNG compression does
+        # not block rendering. Created on the first capture.
+        self._io_executor = None
 
         # run_speed = x1, means running real time, x2 means fast-forward times
         # two.
         self._run_speed = 1.0
+        self._inv_run_speed = 1.0
         self._loop_count = 0
         self._render_every_frame = False
 
         self._show_mocap = True  # Show / hide mocap bodies.
+        # Geoms of mocap bodies, and while they are hidden the model, geoms
+        # and alpha to restore.
+        self._mocap_geom_model = None
+        self._get_mocap_geom_idx()
+        self._mocap_hidden = None
         self._transparent = False  # Make everything transparent.
 
         # this variable is estamated as a running average.
         self._time_per_render = 1 / 60.0
+        # Derived from _time_per_render whenever it is updated.
+        self._inv_time_per_render = 60.0
+        self._fps_int = 60
         self._hide_overlay = False  # hide the entire overlay.
         self._user_overlay = {}
 
@@ -191,26 +293,55 @@ class MjViewer(MjViewerBasic):
         # display mujoco default text
         self.display_all_text = display_all_text
 
+        # Overlay text that does not change between frames. add_overlay appends
+        # a line per call, so consecutive constant lines are joined up front and
+        # added with a single call.
+        self._static_overlay_entries = [
+            (const.GRID_TOPLEFT,
+             "\n".join(label for label, _ in _CUSTOM_KEYS_OVERLAY),
+             "\n".join(key for _, key in _CUSTOM_KEYS_OVERLAY))]
+        self._static_text_entries = [
+            (const.GRID_TOPLEFT,
+             "Toggle geomgroup visibility\n" + self._static_overlay_entries[0][1],
+             "0-4\n" + self._static_overlay_entries[0][2])]
+        self._pause_overlay_text = {
+            False: ("Stop\nAdvance simulation by one step", "[Space]\n[right arrow]"),
+            True: ("Start\nAdvance simulation by one step", "[Space]\n[right arrow]")}
+        self._camera_overlay_label = "Switch camera (#cams = %d)" % (self._ncam + 1)
+        self._dots_table = [("." * n) + (" " * (6 - n)) for n in range(7)]
+        self._dots_tick = 0
+
         # scaling factor on external force to apply to body
         self.external_force = 0
 
         # additional mass for pick up object
         self.additional_mass = 0
 
-        # various gravities
-        self.gravities = {
-            'earth': np.array([0, 0, -9.81]),
-            'moon': np.array([0, 0, -1.62]),
-            'mars': np.array([0, 0, -3.71]),
-            'jupiter': np.array([0, 0, -24.92]),
-            'ISS': np.array([0, 0, 0]),
-            }
+        # various gravities and the world gravity, created on first use
+        self._gravities = None
+        self._gravity = None
         self.planet = 'earth'
 
-        # world gravity
-        self.gravity = self.gravities['earth']
+    @property
+    def gravities(self):
+        if self._gravities is None:
+            self._gravities = {planet: np.array([0, 0, g])
+                               for planet, g in self._GRAVITIES.items()}
+        return self._gravities
 
+    @gravities.setter
+    def gravities(self, value):
+        self._gravities = value
 
+    @property
+    def gravity(self):
+        if self._gravity is None:
+            self._gravity = self.gravities['earth']
+        return self._gravity
+
+    @gravity.setter
+    def gravity(self, value):
+        self._gravity = value
 
     def render(self):
         """
@@ -219,86 +350,220 @@ class MjViewer(MjViewerBasic):
         """
 
         def render_inner_loop(self):
-            render_start = time.time()
+            render_start = time.perf_counter()
 
-            self._overlay.clear()
+            self._overlay_reset()
             if not self._hide_overlay:
-                for k, v in self._user_overlay.items():
-                    self._overlay[k] = copy.deepcopy(v)
+                for k, (text1, text2) in self._user_overlay.items():
+                    entry = self._overlay.get(k)
+                    if entry is None:
+                        entry = self._overlay[k] = ["", ""]
+                    entry[0] = text1
+                    entry[1] = text2
                 self._create_full_overlay()
             super().render()
             if self._record_video:
-                frame = self._read_pixels_as_in_window()
-                self._video_queue.put(frame)
+                frame = self._read_pixels_as_in_window(pipelined=True)
+                if frame is not None and not self._push_video_frame(frame):
+                    print("Video encoder stopped, recording aborted", file=sys.stderr)
+                    self._toggle_video()
             else:
                 self._time_per_render = 0.9 * self._time_per_render + \
-                    0.1 * (time.time() - render_start)
-
-        self._user_overlay = copy.deepcopy(self._overlay)
+                    0.1 * (time.perf_counter() - render_start)
+                self._inv_time_per_render = 1.0 / self._time_per_render
+                self._fps_int = int(self._inv_time_per_render)
+
+        def wait_inner_loop(self):
+            # Takes as long as rendering a frame, handling input meanwhile.
+            # Returns early if the input changed the scene.
+            deadline = time.perf_counter() + self._time_per_render
+            remaining = self._time_per_render
+            while remaining > 0 and not self._dirty:
+                glfw.wait_events_timeout(remaining)
+                remaining = deadline - time.perf_counter()
+
+        # _overlay_reset empties the [text1, text2] lists in place, so the
+        # user's overlay is kept as tuples.
+        self._user_overlay = {k: (v[0], v[1]) for k, v in self._overlay.items()
+                              if v[0] or v[1]}
+        # The simulation may have changed since the last call.
+        self._dirty = True
         # Render the same frame if paused.
         if self._paused:
             while self._paused:
-                render_inner_loop(self)
+                if self._dirty or self._record_video:
+                    self._dirty = False
+                    render_inner_loop(self)
+                else:
+                    # Nothing changed, so wait for input instead of
+                    # rendering the same image again.
+                    glfw.wait_events_timeout(1.0 / 60.0)
                 if self._advance_by_one_step:
                     self._advance_by_one_step = False
                     break
         else:
             # inner_loop runs "_loop_count" times in expectation (where "_loop_count" is a float).
             # Therefore, frames are displayed in the real-time.
-            self._loop_count += self.sim.model.opt.timestep * self.sim.nsubsteps / \
-                (self._time_per_render * self._run_speed)
+            self._loop_count += self.sim.model.opt.timestep * self.sim.nsubsteps * \
+                self._inv_time_per_render * self._inv_run_speed
             if self._render_every_frame:
                 self._loop_count = 1
             while self._loop_count > 0:
-                render_inner_loop(self)
+                if self._dirty or self._record_video or self._render_every_frame:
+                    self._dirty = False
+                    render_inner_loop(self)
+                else:
+                    # The scene is unchanged since the last pass, so wait
+                    # instead of rendering the same image again.
+                    wait_inner_loop(self)
                 self._loop_count -= 1
         # Markers and overlay are regenerated in every pass.
         self._markers[:] = []
-        self._overlay.clear()
+        self._overlay_reset()
 
-    def _read_pixels_as_in_window(self, resolution=None):
+    def _read_pixels_as_in_window(self, resolution=None, pipelined=False):
         # Reads pixels with markers and overlay from the same camera as screen.
+        # If pipelined, the frame rendered by the previous call is returned
+        # (None on the first call), see _read_pixels_pipelined.
         if resolution is None:
-            resolution = glfw.get_framebuffer_size(self.sim._render_context_window.window)
+            resolution = (self._fb_w, self._fb_h)
 
-        resolution = np.array(resolution)
-        resolution = resolution * min(1000 / np.min(resolution), 1)
-        resolution = resolution.astype(np.int32)
-        resolution -= resolution % 16
+        resolution = self._capture_resolution(*resolution)
         if self.sim._render_context_offscreen is None:
             self.sim.render(resolution[0], resolution[1])
         offscreen_ctx = self.sim._render_context_offscreen
         window_ctx = self.sim._render_context_window
-        # Save markers and overlay from offscreen.
-        saved = [copy.deepcopy(offscreen_ctx._markers),
-                 copy.deepcopy(offscreen_ctx._overlay),
-                 rec_copy(offscreen_ctx.cam)]
+        # Save markers and overlay from offscreen. Usually only the viewer
+        # renders offscreen, so they are empty and need no copy.
+        saved_markers = list(offscreen_ctx._markers) if offscreen_ctx._markers else None
+        saved_overlay = dict(offscreen_ctx._overlay) if offscreen_ctx._overlay else None
+        saved_cam = _snapshot_cam(offscreen_ctx.cam)
         # Copy markers and overlay from window.
-        offscreen_ctx._markers[:] = window_ctx._markers[:]
+        offscreen_ctx._markers[:] = window_ctx._markers
         offscreen_ctx._overlay.clear()
         offscreen_ctx._overlay.update(window_ctx._overlay)
-        rec_assign(offscreen_ctx.cam, rec_copy(window_ctx.cam))
+        _restore_cam(offscreen_ctx.cam, _snapshot_cam(window_ctx.cam))
 
-        img = self.sim.render(*resolution)
-        img = img[::-1, :, :] # Rendered images are upside-down.
+        if pipelined:
+            img = self._read_pixels_pipelined(offscreen_ctx, *resolution)
+        else:
+            img = self.sim.render(*resolution)
+        if img is not None:
+            img = img[::-1, :, :] # Rendered images are upside-down.
         # Restore markers and overlay to offscreen.
-        offscreen_ctx._markers[:] = saved[0][:]
+        offscreen_ctx._markers.clear()
+        if saved_markers is not None:
+            offscreen_ctx._markers.extend(saved_markers)
         offscreen_ctx._overlay.clear()
-        offscreen_ctx._overlay.update(saved[1])
-        rec_assign(offscreen_ctx.cam, saved[2])
+        if saved_overlay is not None:
+            offscreen_ctx._overlay.update(saved_overlay)
+        _restore_cam(offscreen_ctx.cam, saved_cam)
+        return img
+
+    def _capture_resolution(self, width, height):
+        # Captures are at most 1000 pixels on the short side, with both sides
+        # rounded down to multiples of 16 for the video encoder.
+        resolution = self._cached_capture_res.get((width, height))
+        if resolution is None:
+            scale = min(1000.0 / min(width, height), 1.0)
+            resolution = (int(width * scale) & ~15, int(height * scale) & ~15)
+            self._cached_capture_res[(width, height)] = resolution
+        return resolution
+
+    def _read_pixels_pipelined(self, offscreen_ctx, width, height):
+        # Frame N is read into one PBO while frame N - 1 is copied out of the
+        # other, so the GPU transfer overlaps with rendering the next frame
+        # instead of stalling on it.
+        if self._pbo_size != (width, height):
+            self._free_pbo_ring()
+            with cymj._MjSim_render_lock:
+                self._pbo_ring = [offscreen_ctx.create_pbo(width, height) for _ in range(2)]
+            self._pbo_size = (width, height)
+            if self._pbo_ring[0]:
+                self._pbo_read_buf = np.empty((height, width, 3), dtype=np.uint8)
+        if not self._pbo_ring[0]:
+            # PBOs are not supported by this backend, read synchronously.
+            return self.sim.render(width, height)
+
+        # The window context was made current by the on-screen render, and
+        # the PBOs belong to the offscreen one. Hold the lock sim.render uses.
+        with cymj._MjSim_render_lock:
+            offscreen_ctx.opengl_context.make_context_current()
+            offscreen_ctx.render(width, height)
+            offscreen_ctx.read_pixels_to_pbo(width, height, self._pbo_ring[self._pbo_idx])
+            img = self._read_pending_pbo(offscreen_ctx)
+        self._pbo_idx = 1 - self._pbo_idx
+        self._pbo_pending = True
         return img
 
+    def _free_pbo_ring(self):
+        # Frees the PBOs on resize and when recording stops. Not done from
+        # __del__, as GL calls cannot be made from an arbitrary thread.
+        offscreen_ctx = self.sim._render_context_offscreen
+        if offscreen_ctx is not None:
+            with cymj._MjSim_render_lock:
+                for pbo in self._pbo_ring:
+                    offscreen_ctx.free_pbo(pbo)
+        self._pbo_ring = [0, 0]
+        self._pbo_size = None
+        self._pbo_pending = False
+        self._pbo_read_buf = None
+
+    def _read_pending_pbo(self, offscreen_ctx):
+        # Returns the frame in the PBO written by the previous pipelined
+        # read, or None if there is none. The frame is read into a buffer
+        # that is reused by the next read; _push_video_frame does the single
+        # copy out of it, flipping the rows on the way.
+        if not self._pbo_pending:
+            return None
+        self._pbo_pending = False
+        width, height = self._pbo_size
+        return offscreen_ctx.read_pbo(width, height, self._pbo_ring[1 - self._pbo_idx],
+                                      out=self._pbo_read_buf)
+
+    def _get_mocap_geom_idx(self):
+        # Indices of geoms attached to mocap bodies, recomputed only when the
+        # model changes.
+        model = self.sim.model
+        if self._mocap_geom_model is not model:
+            mocap_bodies = np.where(model.body_mocapid != -1)[0]
+            self._mocap_geom_idx = np.where(np.isin(model.geom_bodyid, mocap_bodies))[0]
+            self._mocap_geom_model = model
+        return self._mocap_geom_idx
+
+    def _push_video_frame(self, frame):
+        # Copies frame into the next slot of the ring, waiting for the encoder
+        # thread to free one if it has fallen behind. None ends the video.
+        # Returns False if the encoder thread has stopped.
+        while not self._frame_free.acquire(timeout=0.1):
+            if self._frame_stopped.is_set():
+                return False
+        if self._frame_stopped.is_set():
+            self._frame_free.release()  # so later pushes fail without waiting
+            return False
+        if frame is None:
+            self._frame_ring[self._frame_tail] = None
+        else:
+            buf = self._frame_ring[self._frame_tail]
+            if buf is None or buf.shape != frame.shape:
+                buf = np.empty(frame.shape, dtype=np.uint8)
+                self._frame_ring[self._frame_tail] = buf
+            np.copyto(buf, frame)
+        self._frame_tail = (self._frame_tail + 1) % len(self._frame_ring)
+        self._frame_filled.release()
+        return True
+
     def _create_full_overlay(self):
         if self.display_all_text:
             if self._render_every_frame:
                 self.add_overlay(const.GRID_TOPLEFT, "", "")
             else:
-                self.add_overlay(const.GRID_TOPLEFT, "Run speed = %.3f x real time" %
-                                self._run_speed, "[S]lower, [F]aster")
+                self.add_overlay(const.GRID_TOPLEFT, f"Run speed = {self._run_speed:.3f} x real time",
+                                "[S]lower, [F]aster")
             self.add_overlay(
                 const.GRID_TOPLEFT, "Ren[d]er every frame", "Off" if self._render_every_frame else "On")
-            self.add_overlay(const.GRID_TOPLEFT, "Switch camera (#cams = %d)" % (self._ncam + 1),
-                                                "[Tab] (camera ID = %d)" % self.cam.fixedcamid)
+            self.add_overlay(const.GRID_TOPLEFT, self._camera_overlay_label,
+                                                f"[Tab] (camera ID = {self.cam.fixedcamid})")
             self.add_overlay(const.GRID_TOPLEFT, "[C]ontact forces", "Off" if self.vopt.flags[
                             10] == 1 else "On")
             self.add_overlay(
@@ -308,255 +573,279 @@ class MjViewer(MjViewerBasic):
             self.add_overlay(
                 const.GRID_TOPLEFT, "Display [M]ocap bodies", "On" if self._show_mocap else "Off")
             if self._paused is not None:
-                if not self._paused:
-                    self.add_overlay(const.GRID_TOPLEFT, "Stop", "[Space]")
-                else:
-                    self.add_overlay(const.GRID_TOPLEFT, "Start", "[Space]")
-                self.add_overlay(const.GRID_TOPLEFT,
-                                "Advance simulation by one step", "[right arrow]")
+                text1, text2 = self._pause_overlay_text[self._paused]
+                self.add_overlay(const.GRID_TOPLEFT, text1, text2)
             self.add_overlay(const.GRID_TOPLEFT, "[H]ide Menu", "")
             if self._record_video:
-                ndots = int(7 * (time.time() % 1))
-                dots = ("." * ndots) + (" " * (6 - ndots))
+                self._dots_tick = (self._dots_tick + 1) % 7
+                dots = self._dots_table[self._dots_tick]
                 self.add_overlay(const.GRID_TOPLEFT,
                                 "Record [V]ideo (On) " + dots, "")
             else:
                 self.add_overlay(const.GRID_TOPLEFT, "Record [V]ideo (Off) ", "")
             if self._video_idx > 0:
                 fname = self._video_path % (self._video_idx - 1)
-                self.add_overlay(const.GRID_TOPLEFT, "   saved as %s" % fname, "")
+                self.add_overlay(const.GRID_TOPLEFT, f"   saved as {fname}", "")
 
             self.add_overlay(const.GRID_TOPLEFT, "Cap[t]ure frame", "")
             if self._image_idx > 0:
                 fname = self._image_path % (self._image_idx - 1)
-                self.add_overlay(const.GRID_TOPLEFT, "   saved as %s" % fname, "")
+                self.add_overlay(const.GRID_TOPLEFT, f"   saved as {fname}", "")
             self.add_overlay(const.GRID_TOPLEFT, "Start [i]pdb", "")
             if self._record_video:
                 extra = " (while video is not recorded)"
             else:
                 extra = ""
-            self.add_overlay(const.GRID_BOTTOMLEFT, "FPS", "%d%s" %
-                            (1 / self._time_per_render, extra))
+            self.add_overlay(const.GRID_BOTTOMLEFT, "FPS", f"{self._fps_int}{extra}")
             self.add_overlay(const.GRID_BOTTOMLEFT, "Solver iterations", str(
                 self.sim.data.solver_iter + 1))
             step = round(self.sim.data.time / self.sim.model.opt.timestep)
             self.add_overlay(const.GRID_BOTTOMRIGHT, "Step", str(step))
-            self.add_overlay(const.GRID_BOTTOMRIGHT, "timestep", "%.5f" % self.sim.model.opt.timestep)
+            self.add_overlay(const.GRID_BOTTOMRIGHT, "timestep", f"{self.sim.model.opt.timestep:.5f}")
             self.add_overlay(const.GRID_BOTTOMRIGHT, "n_substeps", str(self.sim.nsubsteps))
-            self.add_overlay(const.GRID_TOPLEFT, "Toggle geomgroup visibility", "0-4")
-
-        # CUSTOM KEYS
-        self.add_overlay(const.GRID_TOPLEFT, "Toggle adaptation", "[LEFT SHIFT]")
-        self.add_overlay(const.GRID_TOPLEFT, "Move target - X", "[o]")
-        self.add_overlay(const.GRID_TOPLEFT, "Move target + X", "[p]")
-        self.add_overlay(const.GRID_TOPLEFT, "Move target - Y", "[l]")
-        self.add_overlay(const.GRID_TOPLEFT, "Move target + Y", "[;]")
-        self.add_overlay(const.GRID_TOPLEFT, "Move target - Z", "[.]")
-        self.add_overlay(const.GRID_TOPLEFT, "Move target + Z", "[/]")
-        self.add_overlay(const.GRID_TOPLEFT, "Follow target", "[a]")
-        self.add_overlay(const.GRID_TOPLEFT, "Pick up object", "[z]")
-        self.add_overlay(const.GRID_TOPLEFT, "Drop off up object", "[x]")
-        self.add_overlay(const.GRID_TOPLEFT, "Toggle path vis", "[w]")
-        self.add_overlay(const.GRID_TOPLEFT, "Increase gravity", "[g]")
-        self.add_overlay(const.GRID_TOPLEFT, "Decrease gravity", "[b]")
-        self.add_overlay(const.GRID_TOPLEFT, "Dumbbell mass +1kg", "[u]")
-        self.add_overlay(const.GRID_TOPLEFT, "Dumbbell mass -1kg", "[y]")
-        self.add_overlay(const.GRID_TOPLEFT, "Earth Gravity", "[q]")
-        self.add_overlay(const.GRID_TOPLEFT, "Moon Gravity", "[i]")
-        self.add_overlay(const.GRID_TOPLEFT, "Mars Gravity", "[k]")
-        self.add_overlay(const.GRID_TOPLEFT, "Jupiter Gravity", "[,]")
-        self.add_overlay(const.GRID_TOPLEFT, "ISS Gravity", "[qj")
-
-        self.add_overlay(const.GRID_TOPRIGHT, "Adaptation: %s"%self.adapt, "")
-        self.add_overlay(const.GRID_TOPRIGHT, "%s"%self.reach_mode, "")
-        self.add_overlay(const.GRID_TOPRIGHT, "%s"%self.custom_print, "")
+            # Custom keys, prefixed by the geomgroup line.
+            static_entries = self._static_text_entries
+        else:
+            static_entries = self._static_overlay_entries
+        for gridpos, text1, text2 in static_entries:
+            self.add_overlay(gridpos, text1, text2)
+
+        self.add_overlay(const.GRID_TOPRIGHT, f"Adaptation: {self.adapt}", "")
+        self.add_overlay(const.GRID_TOPRIGHT, f"{self.reach_mode}", "")
+        self.add_overlay(const.GRID_TOPRIGHT, f"{self.custom_print}", "")
 
     def key_callback(self, window, key, scancode, action, mods):
-        # on button press (for button holding)
-        if action != glfw.RELEASE:
-            # adjust object location up / down
-            # X
-            if key == glfw.KEY_O:
-                self.target_x = -1
-            elif key == glfw.KEY_P:
-                self.target_x = 1
-            # Y
-            elif key == glfw.KEY_L:
-                self.target_y = -1
-            elif key == glfw.KEY_SEMICOLON:
-                self.target_y = 1
-            # Z
-            elif key == glfw.KEY_PERIOD:
-                self.target_z = -1
-            elif key == glfw.KEY_SLASH:
-                self.target_z = 1
-
-            super().key_callback(window, key, scancode, action, mods)
-
-        # on button release (click)
+        if action == glfw.RELEASE:
+            # on button release (click)
+            handler = self._RELEASE_TABLE.get(key)
         else:
-            if key == glfw.KEY_TAB:  # Switches cameras.
-                self.cam.fixedcamid += 1
-                self.cam.type = const.CAMERA_FIXED
-                if self.cam.fixedcamid >= self._ncam:
-                    self.cam.fixedcamid = -1
-                    self.cam.type = const.CAMERA_FREE
-            elif key == glfw.KEY_H:  # hides all overlay.
-                self._hide_overlay = not self._hide_overlay
-            elif key == glfw.KEY_SPACE and self._paused is not None:  # stops simulation.
-                self._paused = not self._paused
-            # Advances simulation by one step.
-            elif key == glfw.KEY_RIGHT and self._paused is not None:
-                self._advance_by_one_step = True
-                self._paused = True
-            elif key == glfw.KEY_V or \
-                    (key == glfw.KEY_ESCAPE and self._record_video):  # Records video. Trigers with V or if in progress by ESC.
-                self._record_video = not self._record_video
-                if self._record_video:
-                    fps = (1 / self._time_per_render)
-                    self._video_process = Process(target=save_video,
-                                    args=(self._video_queue, self._video_path % self._video_idx, fps))
-                    self._video_process.start()
-                if not self._record_video:
-                    self._video_queue.put(None)
-                    self._video_process.join()
-                    self._video_idx += 1
-            elif key == glfw.KEY_T:  # capture screenshot
-                img = self._read_pixels_as_in_window()
-                imageio.imwrite(self._image_path % self._image_idx, img)
-                self._image_idx += 1
-            # elif key == glfw.KEY_I:  # drops in debugger.
-            #     try:
-            #         import ipdb
-            #         ipdb.set_trace()
-            #         print('You can access the simulator by self.sim')
-            #     except ImportError:
-            #         print('pip install ipdb to use debugger')
-            elif key == glfw.KEY_S:  # Slows down simulation.
-                self._run_speed /= 2.0
-            elif key == glfw.KEY_F:  # Speeds up simulation.
-                self._run_speed *= 2.0
-            elif key == glfw.KEY_C:  # Displays contact forces.
-                vopt = self.vopt
-                vopt.flags[10] = vopt.flags[11] = not vopt.flags[10]
-            elif key == glfw.KEY_D:  # turn off / turn on rendering every frame.
-                self._render_every_frame = not self._render_every_frame
-
-            elif key == glfw.KEY_E:
-                vopt = self.vopt
-                vopt.frame = 1 - vopt.frame
-
-            elif key == glfw.KEY_R:  # makes everything little bit transparent.
-                self._transparent = not self._transparent
-                if self._transparent:
-                    self.sim.model.geom_rgba[:, 3] /= 5.0
-                else:
-                    self.sim.model.geom_rgba[:, 3] *= 5.0
-            elif key == glfw.KEY_M:  # Shows / hides mocap bodies
-                self._show_mocap = not self._show_mocap
-                for body_idx1, val in enumerate(self.sim.model.body_mocapid):
-                    if val != -1:
-                        for geom_idx, body_idx2 in enumerate(self.sim.model.geom_bodyid):
-                            if body_idx1 == body_idx2:
-                                if not self._show_mocap:
-                                    # Store transparency for later to show it.
-                                    self.sim.extras[
-                                        geom_idx] = self.sim.model.geom_rgba[geom_idx, 3]
-                                    self.sim.model.geom_rgba[geom_idx, 3] = 0
-                                else:
-                                    self.sim.model.geom_rgba[
-                                        geom_idx, 3] = self.sim.extras[geom_idx]
-            elif key in (glfw.KEY_0, glfw.KEY_1, glfw.KEY_2, glfw.KEY_3, glfw.KEY_4):
-                self.vopt.geomgroup[key - glfw.KEY_0] ^= 1
-            elif glfw.get_key(window, glfw.KEY_LEFT_CONTROL) and 290 <= key <= 301:
-                # index into the last 12 elements of mjtVisFrame
-                keynum = min(key - 290 + 12, 21)
-                vopt = self.vopt
-                vopt.flags[keynum] = vopt.flags[keynum] = not vopt.flags[keynum]
-            elif 290 <= key <= 301:
-                # index into the first 12 elements of mjtVisFrame
-                keynum = key - 290
-                vopt = self.vopt
-                vopt.flags[keynum] = vopt.flags[keynum] = not vopt.flags[keynum]
-            # adjust object location up / down
-            # X
-            elif key == glfw.KEY_O:
-                self.target_x = -1
-            elif key == glfw.KEY_P:
-                self.target_x = 1
-            # Y
-            elif key == glfw.KEY_L:
-                self.target_y = -1
-            elif key == glfw.KEY_SEMICOLON:
-                self.target_y = 1
-            # Z
-            elif key == glfw.KEY_PERIOD:
-                self.target_z = -1
-            elif key == glfw.KEY_SLASH:
-                self.target_z = 1
-
-            # user command to reach to target
-            elif key == glfw.KEY_A:
-                self.reach_mode = 'reach_target'
-            # user command to pick up object
-            elif key == glfw.KEY_Z:
-                self.reach_mode = 'pick_up'
-            # user command to drop off object
-            elif key == glfw.KEY_X:
-                self.reach_mode = 'drop_off'
-            elif key == glfw.KEY_W:
-                self.path_vis = not self.path_vis
-
-            # toggle adaptation
-            elif key == glfw.KEY_LEFT_SHIFT:
-                self.adapt = not self.adapt
-
-            # TODO: comment this out for demo
-            # toggle gripper
-            elif key == glfw.KEY_N:
-                self.gripper *= -1
-
-            # scaling factor on external force
-            elif key == glfw.KEY_G:
-                self.external_force += 1
-
-            elif key == glfw.KEY_B:
-                self.external_force -= 1
-
-            # scaling factor on external force
-            elif key == glfw.KEY_U:
-                self.additional_mass = 1
-
-            elif key == glfw.KEY_Y:
-                self.additional_mass = -1
-
-            # set the world gravity
-            elif key == glfw.KEY_Q:
-                self.planet = 'earth'
-
-            elif key == glfw.KEY_K:
-                self.planet = 'mars'
-
-            elif key == glfw.KEY_COMMA:
-                self.planet = 'jupiter'
-
-            elif key == glfw.KEY_I:
-                self.planet = 'moon'
-
-            elif key == glfw.KEY_J:
-                self.planet = 'ISS'
-
-            super().key_callback(window, key, scancode, action, mods)
-
-# Separate Process to save video. This way visualization is
-# less slowed down.
-
-
-def save_video(queue, filename, fps):
-    writer = imageio.get_writer(filename, fps=fps)
-    while True:
-        frame = queue.get()
-        if frame is None:
-            break
-        writer.append_data(frame)
-    writer.close()
+            # on button press (for button holding)
+            handler = self._PRESS_TABLE.get(key)
+        if handler is not None:
+            handler(self)
+            self._dirty = True
+        super().key_callback(window, key, scancode, action, mods)
+
+    def _cycle_camera(self):  # Switches cameras.
+        self.cam.fixedcamid += 1
+        self.cam.type = const.CAMERA_FIXED
+        if self.cam.fixedcamid >= self._ncam:
+            self.cam.fixedcamid = -1
+            self.cam.type = const.CAMERA_FREE
+
+    def _toggle_overlay(self):  # hides all overlay.
+        self._hide_overlay = not self._hide_overlay
+
+    def _toggle_pause(self):  # stops simulation.
+        if self._paused is not None:
+            self._paused = not self._paused
+
+    def _advance_one_step(self):  # Advances simulation by one step.
+        if self._paused is not None:
+            self._advance_by_one_step = True
+            self._paused = True
+
+    def _stop_video(self):  # ESC also stops a video in progress.
+        if self._record_video:
+            self._toggle_video()
+
+    def _toggle_video(self):  # Records video.
+        self._record_video = not self._record_video
+        if self._record_video:
+            fps = self._inv_time_per_render
+            self._frame_ring = [None] * self._video_ring_size
+            self._frame_free = Semaphore(self._video_ring_size)
+            self._frame_filled = Semaphore(0)
+            self._frame_stopped = Event()
+            self._frame_tail = 0
+            self._video_thread = Thread(target=save_video,
+                            args=(self._frame_ring, self._frame_free, self._frame_filled,
+                                  self._frame_stopped, self._video_path % self._video_idx, fps))
+            self._video_thread.start()
+        if not self._record_video:
+            with cymj._MjSim_render_lock:
+                frame = self._read_pending_pbo(self.sim._render_context_offscreen)
+            self._free_pbo_ring()
+            if frame is not None:
+                self._push_video_frame(frame[::-1, :, :])
+            self._push_video_frame(None)
+            self._video_thread.join()
+            self._video_idx += 1
+
+    def _capture_frame(self):  # capture screenshot
+        img = self._read_pixels_as_in_window()
+        if self._io_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._io_executor = ThreadPoolExecutor(max_workers=1)
+        future = self._io_executor.submit(
+            imageio.imwrite, self._image_path % self._image_idx, img)
+        future.add_done_callback(_report_io_error)
+        self._image_idx += 1
+
+    def _slow_down(self):  # Slows down simulation.
+        self._run_speed /= 2.0
+        self._inv_run_speed = 1.0 / self._run_speed
+
+    def _speed_up(self):  # Speeds up simulation.
+        self._run_speed *= 2.0
+        self._inv_run_speed = 1.0 / self._run_speed
+
+    def _toggle_contact_forces(self):  # Displays contact forces.
+        vopt = self.vopt
+        vopt.flags[10] = vopt.flags[11] = not vopt.flags[10]
+
+    def _toggle_render_every_frame(self):  # turn off / turn on rendering every frame.
+        self._render_every_frame = not self._render_every_frame
+
+    def _toggle_reference_frames(self):
+        vopt = self.vopt
+        vopt.frame = 1 - vopt.frame
+
+    def _toggle_transparency(self):  # makes everything little bit transparent.
+        self._transparent = not self._transparent
+        if self._transparent:
+            self.sim.model.geom_rgba[:, 3] /= 5.0
+        else:
+            self.sim.model.geom_rgba[:, 3] *= 5.0
+
+    def _toggle_mocap(self):  # Shows / hides mocap bodies
+        self._show_mocap = not self._show_mocap
+        model = self.sim.model
+        if not self._show_mocap:
+            # Store transparency for later to show it.
+            geom_idx = self._get_mocap_geom_idx()
+            self._mocap_hidden = (model, geom_idx, model.geom_rgba[geom_idx, 3].copy())
+            model.geom_rgba[geom_idx, 3] = 0
+        elif self._mocap_hidden is not None:
+            hidden_model, geom_idx, alpha = self._mocap_hidden
+            # A model swapped in since hiding never had its geoms hidden.
+            if hidden_model is model:
+                model.geom_rgba[geom_idx, 3] = alpha
+            self._mocap_hidden = None
+
+    def _toggle_geomgroup(self, group):
+        self.vopt.geomgroup[group] ^= 1
+
+    def _toggle_vis_flag(self, fkey):
+        if glfw.get_key(self.window, glfw.KEY_LEFT_CONTROL):
+            # index into the last 12 elements of mjtVisFrame
+            keynum = min(fkey + 12, 21)
+        else:
+            # index into the first 12 elements of mjtVisFrame
+            keynum = fkey
+        vopt = self.vopt
+        vopt.flags[keynum] = not vopt.flags[keynum]
+
+    def _toggle_path_vis(self):
+        self.path_vis = not self.path_vis
+
+    def _toggle_adaptation(self):
+        self.adapt = not self.adapt
+
+    def _toggle_gripper(self):  # manual toggle of gripper status
+        self.gripper *= -1
+
+    def _change_external_force(self, delta):
+        self.external_force += delta
+
+    # Key handlers dispatched by key_callback, for key press (and repeat)
+    # and for key release. They are stored unbound and called with the viewer.
+    _TARGET_KEYS = {
+        # adjust object location up / down
+        glfw.KEY_O: lambda self: setattr(self, 'target_x', -1),
+        glfw.KEY_P: lambda self: setattr(self, 'target_x', 1),
+        glfw.KEY_L: lambda self: setattr(self, 'target_y', -1),
+        glfw.KEY_SEMICOLON: lambda self: setattr(self, 'target_y', 1),
+        glfw.KEY_PERIOD: lambda self: setattr(self, 'target_z', -1),
+        glfw.KEY_SLASH: lambda self: setattr(self, 'target_z', 1),
+    }
+    _PRESS_TABLE = dict(_TARGET_KEYS)
+    _RELEASE_TABLE = dict(_TARGET_KEYS)
+    _RELEASE_TABLE.update({
+        glfw.KEY_TAB: _cycle_camera,
+        glfw.KEY_H: _toggle_overlay,
+        glfw.KEY_SPACE: _toggle_pause,
+        glfw.KEY_RIGHT: _advance_one_step,
+        glfw.KEY_V: _toggle_video,
+        glfw.KEY_ESCAPE: _stop_video,
+        glfw.KEY_T: _capture_frame,
+        glfw.KEY_S: _slow_down,
+        glfw.KEY_F: _speed_up,
+        glfw.KEY_C: _toggle_contact_forces,
+        glfw.KEY_D: _toggle_render_every_frame,
+        glfw.KEY_E: _toggle_reference_frames,
+        glfw.KEY_R: _toggle_transparency,
+        glfw.KEY_M: _toggle_mocap,
+        # user command to reach to target, pick up or drop off object
+        glfw.KEY_A: lambda self: setattr(self, 'reach_mode', 'reach_target'),
+        glfw.KEY_Z: lambda self: setattr(self, 'reach_mode', 'pick_up'),
+        glfw.KEY_X: lambda self: setattr(self, 'reach_mode', 'drop_off'),
+        glfw.KEY_W: _toggle_path_vis,
+        glfw.KEY_LEFT_SHIFT: _toggle_adaptation,
+        # TODO: comment this out for demo
+        glfw.KEY_N: _toggle_gripper,
+        # scaling factor on external force
+        glfw.KEY_G: lambda self: self._change_external_force(1),
+        glfw.KEY_B: lambda self: self._change_external_force(-1),
+        # additional mass for pick up object
+        glfw.KEY_U: lambda self: setattr(self, 'additional_mass', 1),
+        glfw.KEY_Y: lambda self: setattr(self, 'additional_mass', -1),
+        # set the world gravity
+        glfw.KEY_Q: lambda self: setattr(self, 'planet', 'earth'),
+        glfw.KEY_K: lambda self: setattr(self, 'planet', 'mars'),
+        glfw.KEY_COMMA: lambda self: setattr(self, 'planet', 'jupiter'),
+        glfw.KEY_I: lambda self: setattr(self, 'planet', 'moon'),
+        glfw.KEY_J: lambda self: setattr(self, 'planet', 'ISS'),
+    })
+    _RELEASE_TABLE.update({
+        key: lambda self, group=key - glfw.KEY_0: self._toggle_geomgroup(group)
+        for key in (glfw.KEY_0, glfw.KEY_1, glfw.KEY_2, glfw.KEY_3, glfw.KEY_4)})
+    _RELEASE_TABLE.update({
+        key: lambda self, fkey=key - 290: self._toggle_vis_flag(fkey)
+        for key in range(290, 302)})  # F1 - F12
+
+
+def _snapshot_cam(cam):
+    # Copies the fields of an mjvCamera. Cheaper than the generic rec_copy.
+    return (cam.type, cam.fixedcamid, cam.trackbodyid,
+            cam.distance, cam.azimuth, cam.elevation, tuple(cam.lookat))
+
+
+def _restore_cam(cam, snapshot):
+    (cam.type, cam.fixedcamid, cam.trackbodyid,
+     cam.distance, cam.azimuth, cam.elevation, lookat) = snapshot
+    cam.lookat[:] = lookat
+
+
+def _report_io_error(future):
+    if future.exception() is not None:
+        print("Failed to save frame: %s" % future.exception(), file=sys.stderr)
+
+
+# Separate thread to save video. This way visualization is
+# less slowed down; the encoder releases the GIL while writing frames.
+def save_video(frame_ring, free, filled, stopped, filename, fps):
+    # Frame sizes are already multiples of 16, and the ultrafast preset keeps
+    # encoding from falling behind rendering.
+    writer = None
+    try:
+        writer = imageio.get_writer(filename, fps=fps, codec='libx264', macro_block_size=16,
+                                    ffmpeg_params=['-preset', 'ultrafast'])
+        head = 0
+        while True:
+            filled.acquire()
+            frame = frame_ring[head]
+            if frame is None:
+                break
+            writer.append_data(frame)
+            head = (head + 1) % len(frame_ring)
+            free.release()
+    except Exception as e:
+        print("Failed to save video: %s" % e, file=sys.stderr)
+    finally:
+        if writer is not None:
+            writer.close()
+        # Wake a producer blocked on a full ring; it then sees stopped and
+        # stops pushing frames.
+        stopped.set()
+        free.release()
@@ -1,6 +1,10 @@
+import imageio
+import numpy as np
 import pytest
+from threading import Event, Semaphore, Thread
+from types import SimpleNamespace
 from mujoco_py import load_model_from_path, MjSim
-from mujoco_py.mjviewer import MjViewer
+from mujoco_py.mjviewer import MjViewer, save_video
 
 
 @pytest.mark.requires_rendering
@@ -12,3 +16,60 @@ def test_viewer():
     for _ in range(100):
         sim.step()
         viewer.render()
+
+
+class FakeWriter(object):
+    def __init__(self, fail_after=None):
+        self.frames = []
+        self.closed = False
+        self.fail_after = fail_after
+
+    def append_data(self, frame):
+        if len(self.frames) == self.fail_after:
+            raise IOError("disk full")
+        self.frames.append(frame.copy())
+
+    def close(self):
+        self.closed = True
+
+
+def _start_encoder(monkeypatch, writer, ring_size=2):
+    monkeypatch.setattr(imageio, 'get_writer', lambda *args, **kwargs: writer)
+    viewer = SimpleNamespace(
+        _frame_ring=[None] * ring_size, _frame_free=Semaphore(ring_size),
+        _frame_filled=Semaphore(0), _frame_stopped=Event(), _frame_tail=0)
+    viewer._video_thread = Thread(target=save_video, args=(
+        viewer._frame_ring, viewer._frame_free, viewer._frame_filled,
+        viewer._frame_stopped, 'video.mp4', 60))
+    viewer._video_thread.start()
+    return viewer
+
+
+def test_save_video_ring(monkeypatch):
+    writer = FakeWriter()
+    viewer = _start_encoder(monkeypatch, writer)
+    frames = [np.full((16, 16, 3), i, dtype=np.uint8) for i in range(5)]
+    for frame in frames:
+        assert MjViewer._push_video_frame(viewer, frame)
+    assert MjViewer._push_video_frame(viewer, None)
+    viewer._video_thread.join(timeout=5)
+    assert not viewer._video_thread.is_alive()
+    assert writer.closed
+    assert len(writer.frames) == len(frames)
+    for written, frame in zip(writer.frames, frames):
+        assert np.array_equal(written, frame)
+
+
+def test_save_video_writer_error(monkeypatch):
+    writer = FakeWriter(fail_after=1)
+    viewer = _start_encoder(monkeypatch, writer)
+    frame = np.zeros((16, 16, 3), dtype=np.uint8)
+    # The ring fills up once the encoder dies; pushing must not block forever.
+    for _ in range(4):
+        MjViewer._push_video_frame(viewer, frame)
+    viewer._video_thread.join(timeout=5)
+    assert not viewer._video_thread.is_alive()
+    assert writer.closed
+    assert len(writer.frames) == 1
+    assert not MjViewer._push_video_frame(viewer, frame)
+    assert not MjViewer._push_video_frame(viewer, frame)